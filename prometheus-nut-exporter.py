@@ -1,236 +1,598 @@
+import gzip
+import hashlib
+import logging
+import math
 import time
 import os
+import re
+import socket
+import sys
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from urllib.parse import parse_qs
+from wsgiref.simple_server import make_server, WSGIRequestHandler
 
-from nut2 import PyNUTClient
-from prometheus_client import start_http_server
 from prometheus_client.core import GaugeMetricFamily, REGISTRY
+from prometheus_client.exposition import choose_encoder, ThreadingWSGIServer
 
-METRICS = {
-    "device.uptime": {"unit": "'seconds'", "help": "Device uptime"},
-    "ups.temperature": {"unit": "celsius", "help": "UPS temperature"},
-    "ups.load": {"unit": "percent", "help": "Load on UPS"},
-    "ups.load.high": {
-        "unit": "percent",
-        "help": "Load when UPS switches to overload condition",
-    },
-    "ups.efficiency": {
-        "unit": "percent",
-        "help": "Efficiency of the UPS (ratio of the output current on the input current)",
-    },
-    "ups.power": {"unit": "voltamperes", "help": "Current value of apparent power"},
-    "ups.power.nominal": {
-        "unit": "voltamperes",
-        "help": "Nominal value of apparent power",
-    },
-    "ups.realpower": {"unit": "watts", "help": "Current value of real power"},
-    "ups.realpower.nominal": {"unit": "watts", "help": "Nominal value of real power"},
-    "input.voltage": {"unit": "volts", "help": "Input voltage"},
-    "input.voltage.maximum": {"unit": "volts", "help": "Maximum incoming voltage seen"},
-    "input.voltage.minimum": {"unit": "volts", "help": "Minimum incoming voltage seen"},
-    "input.voltage.low.warning": {"unit": "volts", "help": "Low warning threshold"},
-    "input.voltage.low.critical": {"unit": "volts", "help": "Low critical threshold"},
-    "input.voltage.high.warning": {"unit": "volts", "help": "High warning threshold"},
-    "input.voltage.high.critical": {"unit": "volts", "help": "High critical threshold"},
-    "input.voltage.nominal": {"unit": "volts", "help": "Nominal input voltage"},
-    "input.transfer.delay": {
-        "unit": "seconds",
-        "help": "Delay before transfer to mains",
-    },
-    "input.transfer.low": {"unit": "volts", "help": "Low voltage transfer point"},
-    "input.transfer.high": {"unit": "volts", "help": "High voltage transfer point"},
-    "input.transfer.low.min": {
-        "unit": "volts",
-        "help": "smallest settable low voltage transfer point",
-    },
-    "input.transfer.low.max": {
-        "unit": "volts",
-        "help": "greatest settable low voltage transfer point",
-    },
-    "input.transfer.high.min": {
-        "unit": "volts",
-        "help": "smallest settable high voltage transfer point",
-    },
-    "input.transfer.high.max": {
-        "unit": "volts",
-        "help": "greatest settable high voltage transfer point",
-    },
-    "input.current": {"unit": "amperes", "help": "Input current"},
-    "input.current.nominal": {"unit": "amperes", "help": "Nominal input current"},
-    "input.current.low.warning": {"unit": "amperes", "help": "Low warning threshold"},
-    "input.current.low.critical": {"unit": "amperes", "help": "Low critical threshold"},
-    "input.current.high.warning": {"unit": "amperes", "help": "High warning threshold"},
-    "input.current.high.critical": {
-        "unit": "amperes",
-        "help": "High critical threshold",
-    },
-    "input.frequency": {"unit": "hertz", "help": "Input line frequency"},
-    "input.frequency.nominal": {
-        "unit": "hertz",
-        "help": "Nominal input line frequency",
-    },
-    "input.frequency.low": {"unit": "hertz", "help": "Input line frequency low"},
-    "input.frequency.high": {"unit": "hertz", "help": "Input line frequency high"},
-    "input.transfer.boost.low": {
-        "unit": "hertz",
-        "help": "Low voltage boosting transfer point",
-    },
-    "input.transfer.boost.high": {
-        "unit": "hertz",
-        "help": "High voltage boosting transfer point",
-    },
-    "input.transfer.trim.low": {
-        "unit": "ertz",
-        "help": "Low voltage trimming transfer point",
-    },
-    "input.transfer.trim.high": {
-        "unit": "hertz",
-        "help": "High voltage trimming transfer point",
-    },
-    "input.load": {"unit": "percent", "help": "Load on (ePDU) input"},
-    "input.realpower": {
-        "unit": "watts",
-        "help": "Current sum value of all (ePDU) phases real power",
-    },
-    "input.power": {
-        "unit": "voltamperes",
-        "help": "Current sum value of all (ePDU) phases apparent power",
-    },
-    "output.voltage": {"unit": "volts", "help": "Output voltage"},
-    "output.voltage.nominal": {"unit": "volts", "help": "Nominal output voltage"},
-    "output.frequency": {"unit": "hertz", "help": "Output frequency"},
-    "output.frequency.nominal": {"unit": "hertz", "help": "Nominal output frequency"},
-    "output.current": {"unit": "amperes", "help": "Output current"},
-    "output.current.nominal": {"unit": "amperes", "help": "Nominal output current"},
-    "battery.charge": {"unit": "percent", "help": "Battery charge"},
-    "battery.charge.low": {
-        "unit": "percent",
-        "help": "Remaining battery level when UPS switches to LB",
-    },
-    "battery.charge.restart": {
-        "unit": "percent",
-        "help": "Minimum battery level for UPS restart after power-off",
-    },
-    "battery.charge.warning": {
-        "unit": "percent",
-        "help": 'Battery level when UPS switches to "Warning" state',
-    },
-    "battery.voltage": {"unit": "volts", "help": "Battery voltage"},
-    "battery.voltage.nominal": {"unit": "volts", "help": "Nominal battery voltage"},
-    "battery.voltage.low": {
-        "unit": "volts",
-        "help": "Minimum battery voltage, that triggers FSD status",
-    },
-    "battery.voltage.high": {
-        "unit": "volts",
-        "help": "Maximum battery voltage (i.e. battery.charge = 100)",
-    },
-    "battery.capacity": {"unit": "amperehours", "help": "Battery capacity"},
-    "battery.current": {"unit": "amperes", "help": "Battery current"},
-    "battery.current.total": {"unit": "amperes", "help": "Total battery current"},
-    "battery.temperature": {"unit": "celsius", "help": "Battery temperature"},
-    "battery.runtime": {"unit": "seconds", "help": "Battery runtime"},
-    "battery.runtime.low": {
-        "unit": "seconds",
-        "help": "Remaining battery runtime when UPS switches to LB",
-    },
-    "battery.runtime.restart": {
-        "unit": "seconds",
-        "help": "Minimum battery runtime for UPS restart after power-off",
-    },
-    "battery.packs": {"unit": None, "help": "Number of battery packs"},
-    "battery.packs.bad": {"unit": None, "help": "Number of bad battery packs",},
+# (NUT variable, unit suffix, help text) for every exported gauge
+METRICS = (
+    ("device.uptime", "seconds", "Device uptime"),
+    ("ups.temperature", "celsius", "UPS temperature"),
+    ("ups.load", "percent", "Load on UPS"),
+    ("ups.load.high", "percent", "Load when UPS switches to overload condition"),
+    (
+        "ups.efficiency",
+        "percent",
+        "Efficiency of the UPS (ratio of the output current on the input current)",
+    ),
+    ("ups.power", "voltamperes", "Current value of apparent power"),
+    ("ups.power.nominal", "voltamperes", "Nominal value of apparent power"),
+    ("ups.realpower", "watts", "Current value of real power"),
+    ("ups.realpower.nominal", "watts", "Nominal value of real power"),
+    ("input.voltage", "volts", "Input voltage"),
+    ("input.voltage.maximum", "volts", "Maximum incoming voltage seen"),
+    ("input.voltage.minimum", "volts", "Minimum incoming voltage seen"),
+    ("input.voltage.low.warning", "volts", "Low warning threshold"),
+    ("input.voltage.low.critical", "volts", "Low critical threshold"),
+    ("input.voltage.high.warning", "volts", "High warning threshold"),
+    ("input.voltage.high.critical", "volts", "High critical threshold"),
+    ("input.voltage.nominal", "volts", "Nominal input voltage"),
+    ("input.transfer.delay", "seconds", "Delay before transfer to mains"),
+    ("input.transfer.low", "volts", "Low voltage transfer point"),
+    ("input.transfer.high", "volts", "High voltage transfer point"),
+    ("input.transfer.low.min", "volts", "smallest settable low voltage transfer point"),
+    ("input.transfer.low.max", "volts", "greatest settable low voltage transfer point"),
+    (
+        "input.transfer.high.min",
+        "volts",
+        "smallest settable high voltage transfer point",
+    ),
+    (
+        "input.transfer.high.max",
+        "volts",
+        "greatest settable high voltage transfer point",
+    ),
+    ("input.current", "amperes", "Input current"),
+    ("input.current.nominal", "amperes", "Nominal input current"),
+    ("input.current.low.warning", "amperes", "Low warning threshold"),
+    ("input.current.low.critical", "amperes", "Low critical threshold"),
+    ("input.current.high.warning", "amperes", "High warning threshold"),
+    ("input.current.high.critical", "amperes", "High critical threshold"),
+    ("input.frequency", "hertz", "Input line frequency"),
+    ("input.frequency.nominal", "hertz", "Nominal input line frequency"),
+    ("input.frequency.low", "hertz", "Input line frequency low"),
+    ("input.frequency.high", "hertz", "Input line frequency high"),
+    ("input.transfer.boost.low", "hertz", "Low voltage boosting transfer point"),
+    ("input.transfer.boost.high", "hertz", "High voltage boosting transfer point"),
+    ("input.transfer.trim.low", "hertz", "Low voltage trimming transfer point"),
+    ("input.transfer.trim.high", "hertz", "High voltage trimming transfer point"),
+    ("input.load", "percent", "Load on (ePDU) input"),
+    ("input.realpower", "watts", "Current sum value of all (ePDU) phases real power"),
+    (
+        "input.power",
+        "voltamperes",
+        "Current sum value of all (ePDU) phases apparent power",
+    ),
+    ("output.voltage", "volts", "Output voltage"),
+    ("output.voltage.nominal", "volts", "Nominal output voltage"),
+    ("output.frequency", "hertz", "Output frequency"),
+    ("output.frequency.nominal", "hertz", "Nominal output frequency"),
+    ("output.current", "amperes", "Output current"),
+    ("output.current.nominal", "amperes", "Nominal output current"),
+    ("battery.charge", "percent", "Battery charge"),
+    (
+        "battery.charge.low",
+        "percent",
+        "Remaining battery level when UPS switches to LB",
+    ),
+    (
+        "battery.charge.restart",
+        "percent",
+        "Minimum battery level for UPS restart after power-off",
+    ),
+    (
+        "battery.charge.warning",
+        "percent",
+        'Battery level when UPS switches to "Warning" state',
+    ),
+    ("battery.voltage", "volts", "Battery voltage"),
+    ("battery.voltage.nominal", "volts", "Nominal battery voltage"),
+    (
+        "battery.voltage.low",
+        "volts",
+        "Minimum battery voltage, that triggers FSD status",
+    ),
+    (
+        "battery.voltage.high",
+        "volts",
+        "Maximum battery voltage (i.e. battery.charge = 100)",
+    ),
+    ("battery.capacity", "amperehours", "Battery capacity"),
+    ("battery.current", "amperes", "Battery current"),
+    ("battery.current.total", "amperes", "Total battery current"),
+    ("battery.temperature", "celsius", "Battery temperature"),
+    ("battery.runtime", "seconds", "Battery runtime"),
+    (
+        "battery.runtime.low",
+        "seconds",
+        "Remaining battery runtime when UPS switches to LB",
+    ),
+    (
+        "battery.runtime.restart",
+        "seconds",
+        "Minimum battery runtime for UPS restart after power-off",
+    ),
+    ("battery.packs", None, "Number of battery packs"),
+    ("battery.packs.bad", None, "Number of bad battery packs"),
+)
+
+# Exported metric name, help text and unit per NUT variable, built once at import
+_COMPILED_METRICS = {
+    var: (
+        "_".join(part for part in ("nut", var.replace(".", "_"), unit) if part),
+        help_,
+        unit or "",
+    )
+    for var, unit, help_ in METRICS
 }
 
+# Optional status variables, exported as a gauge labelled with the status
+_STATUS_METRICS = (
+    ("ups.beeper.status", "nut_ups_beeper_status", "UPS beeper status"),
+    (
+        "battery.charger.status",
+        "nut_battery_charger_status",
+        "Status of the battery charger",
+    ),
+)
+
+# Label names shared by every scrape; the metric families themselves collect
+# samples and so are rebuilt each time
+_INFO_LABELS = ("manufacturer", "model", "serial", "nut_server", "ups")
+_STATUS_LABELS = ("status", "nut_server", "ups")
+_METRIC_LABELS = ("nut_server", "ups")
+_GROUPED_LABELS = ("nut_server", "ups", "metric", "unit")
+
+# Every variable the collector reads; anything else upsd reports is dropped
+_KEEP_VARS = (
+    frozenset(_COMPILED_METRICS)
+    | {var for var, _, _ in _STATUS_METRICS}
+    | {"device.mfr", "device.model", "device.serial", "ups.status"}
+)
+
+
+def _env_value(environ, name, default, parse, valid):
+    raw = environ.get(name) or default
+    try:
+        value = parse(raw)
+    except ValueError:
+        value = None
+    if value is None or not valid(value):
+        raise EnvironmentError(
+            "Failed because {} has an invalid value: {!r}".format(name, raw)
+        )
+    return value
+
+
+def _parse_ups_names(raw):
+    return tuple(name.strip() for name in raw.split(",") if name.strip())
+
+
+_BOOLEANS = {
+    "1": True,
+    "true": True,
+    "yes": True,
+    "0": False,
+    "false": False,
+    "no": False,
+}
+
+
+def _parse_bool(raw):
+    try:
+        return _BOOLEANS[str(raw).lower()]
+    except KeyError:
+        raise ValueError(raw)
+
+
+@dataclass(frozen=True)
+class Config(object):
+    host: str
+    nut_port: int
+    # UPS names served by the same NUT server
+    ups_names: tuple
+    exporter_port: int
+    poll_interval: float
+    cache_ttl: float
+    grouped: bool
+
+    @classmethod
+    def from_environ(cls, environ=os.environ):
+        """Parse and validate the exporter settings once at startup."""
+        for var in ("HOST", "UPS"):
+            if var not in environ:
+                raise EnvironmentError("Failed because {} is not set.".format(var))
+
+        def is_port(value):
+            return 0 < value < 65536
+
+        return cls(
+            host=_env_value(environ, "HOST", "", str.strip, bool),
+            nut_port=_env_value(environ, "NUT_PORT", 3493, int, is_port),
+            ups_names=_env_value(environ, "UPS", "", _parse_ups_names, bool),
+            exporter_port=_env_value(environ, "EXPORTER_PORT", 9710, int, is_port),
+            poll_interval=_env_value(
+                environ,
+                "POLL_INTERVAL_SECONDS",
+                5,
+                float,
+                lambda v: math.isfinite(v) and v > 0,
+            ),
+            cache_ttl=_env_value(
+                environ,
+                "CACHE_TTL_SECONDS",
+                5,
+                float,
+                lambda v: math.isfinite(v) and v >= 0,
+            ),
+            grouped=_env_value(
+                environ, "GROUPED_METRICS", "false", _parse_bool, lambda v: True
+            ),
+        )
+
+
+class NUTError(Exception):
+    pass
+
+
+class NUTClient(object):
+    """Minimal upsd client that only speaks LIST VAR."""
+
+    def __init__(self, host, port, timeout=5):
+        self._sock = socket.create_connection((host, port), timeout=timeout)
+        self._file = self._sock.makefile("rb")
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+    def _readline(self):
+        line = self._file.readline()
+        if not line:
+            raise NUTError("Connection closed by server")
+        return line.decode("utf-8").rstrip("\n")
+
+    def list_vars(self, ups_name, keep):
+        self._sock.sendall("LIST VAR {}\n".format(ups_name).encode("utf-8"))
+        line = self._readline()
+        if line != "BEGIN LIST VAR {}".format(ups_name):
+            raise NUTError(line)
+
+        # Lines look like: VAR <ups> <name> "<value>"
+        prefix = "VAR {} ".format(ups_name)
+        ups_vars = {}
+        while True:
+            line = self._readline()
+            if line.startswith("END LIST VAR"):
+                return ups_vars
+            if not line.startswith(prefix):
+                continue
+            name, _, value = line[len(prefix) :].partition(" ")
+            if name in keep:
+                value = value[1:-1]
+                if "\\" in value:
+                    value = re.sub(r"\\(.)", r"\1", value)
+                ups_vars[name] = value
+
 
 class NUTCollector(object):
-    def __init__(self, host, nut_port, ups_name):
+    def __init__(self, host, nut_port, ups_names, poll_interval=5, grouped=False):
         self._host = host
-        self._ups_name = ups_name
+        # A name listed twice would share one connection between two
+        # concurrent fetches, so keep each UPS only once
+        self._ups_names = tuple(dict.fromkeys(ups_names))
         self._nut_port = nut_port
+        self._poll_interval = poll_interval
+        # Export every reading as one "nut" family with metric and unit labels
+        # instead of one family per variable
+        self._grouped = grouped
+        # Latest variables per UPS, or None while it cannot be read. Each
+        # poller only rebinds its own pre-existing key, so scrapes can read
+        # the dict without locking
+        self._snapshots = dict.fromkeys(self._ups_names)
+        # One connection per UPS so the parallel fetches never share a socket
+        self._clients = dict.fromkeys(self._ups_names)
+
+    def start(self):
+        """Poll each UPS every poll_interval seconds on its own daemon thread."""
+        for ups_name in self._ups_names:
+            thread = threading.Thread(target=self._poll_loop, args=(ups_name,))
+            thread.daemon = True
+            thread.start()
+
+    def _poll_loop(self, ups_name):
+        # Spread the UPSes over the interval so they don't all hit upsd at
+        # once. crc32 rather than hash() keeps the offset stable across runs.
+        offset = (zlib.crc32(ups_name.encode("utf-8")) & 0xFFFF) / 0xFFFF
+        next_poll = time.monotonic() + offset * self._poll_interval
+        while True:
+            time.sleep(max(0, next_poll - time.monotonic()))
+            was_up = self._snapshots[ups_name] is not None
+            try:
+                self._snapshots[ups_name] = self._fetch_vars(ups_name)
+            except Exception:
+                # nut_up reports the outage for as long as it lasts, so only
+                # log the cause when the UPS first goes down
+                if was_up:
+                    logging.exception("Polling %s on %s failed", ups_name, self._host)
+                # Stop exporting stale readings until NUT answers again
+                self._snapshots[ups_name] = None
+            else:
+                if not was_up:
+                    logging.info("Polling %s on %s recovered", ups_name, self._host)
+            # Skip polls missed during a slow fetch rather than firing them
+            # back to back, keeping this UPS on its own phase
+            behind = time.monotonic() - next_poll
+            next_poll += self._poll_interval * (
+                1 + max(0, behind) // self._poll_interval
+            )
+
+    def poll(self):
+        """Fetch every UPS once, in parallel."""
+        with ThreadPoolExecutor(max_workers=len(self._ups_names)) as pool:
+            results = pool.map(self._fetch_vars, self._ups_names)
+            for ups_name, client_vars in zip(self._ups_names, results):
+                self._snapshots[ups_name] = client_vars
+
+    def _fetch_vars(self, ups_name):
+        # Reuse one connection across polls; upsd may drop it while idle,
+        # so reconnect and retry once before giving up.
+        for attempt in range(2):
+            try:
+                if self._clients[ups_name] is None:
+                    self._clients[ups_name] = NUTClient(self._host, self._nut_port)
+                return self._clients[ups_name].list_vars(ups_name, _KEEP_VARS)
+            except (NUTError, socket.error):
+                if self._clients[ups_name] is not None:
+                    self._clients[ups_name].close()
+                    self._clients[ups_name] = None
+                if attempt:
+                    raise
 
     def collect(self):
-        client = PyNUTClient(host=self._host, port=self._nut_port)
-        client_vars = client.list_vars(self._ups_name)
+        snapshots = list(self._snapshots.items())
         nut_server = "{}:{}".format(self._host, self._nut_port)
 
+        # Always report every UPS so an unreachable NUT server shows up as 0
+        # rather than as missing series
+        up = GaugeMetricFamily(
+            "nut_up",
+            "Whether the last poll of the UPS succeeded",
+            labels=_METRIC_LABELS,
+        )
+        for ups_name, client_vars in snapshots:
+            up.add_metric([nut_server, ups_name], 0.0 if client_vars is None else 1.0)
+        yield up
+
+        ups_vars = [
+            (ups_name, client_vars)
+            for ups_name, client_vars in snapshots
+            if client_vars is not None
+        ]
+        if not ups_vars:
+            return
+
         info = GaugeMetricFamily(
             "nut_device_info",
             "information about the UPS",
-            labels=["manufacturer", "model", "serial", "nut_server", "ups"],
+            labels=_INFO_LABELS,
         )
-        info.add_metric(
-            # APC UPSes seem to add whitespace at the end of the serial number
-            [
-                client_vars["device.mfr"],
-                client_vars["device.model"],
-                client_vars["device.serial"].strip(),
-                nut_server,
-                self._ups_name,
-            ],
-            1,
-        )
-        yield info
-
         ups_status = GaugeMetricFamily(
-            "nut_ups_status", "UPS status", labels=["status", "nut_server", "ups"]
+            "nut_ups_status", "UPS status", labels=_STATUS_LABELS
         )
-        ups_status.add_metric(
-            [client_vars["ups.status"], nut_server, self._ups_name], 1.0
+        statuses = [
+            (var, GaugeMetricFamily(name, help_, labels=_STATUS_LABELS))
+            for var, name, help_ in _STATUS_METRICS
+        ]
+        grouped = GaugeMetricFamily(
+            "nut", "Reading of a NUT variable", labels=_GROUPED_LABELS
         )
-        yield ups_status
+        # Each metric is emitted once with a sample per UPS
+        metrics = {}
 
-        if "ups.beeper.status" in client_vars:
-            ups_beeper_status = GaugeMetricFamily(
-                "nut_ups_beeper_status",
-                "UPS beeper status",
-                labels=["status", "nut_server", "ups"],
+        for ups_name, client_vars in ups_vars:
+            info.add_metric(
+                # APC UPSes seem to add whitespace at the end of the serial number
+                [
+                    client_vars["device.mfr"],
+                    client_vars["device.model"],
+                    client_vars["device.serial"].strip(),
+                    nut_server,
+                    ups_name,
+                ],
+                1,
             )
-            ups_beeper_status.add_metric(
-                [client_vars["ups.beeper.status"], nut_server, self._ups_name], 1.0
+            ups_status.add_metric(
+                [client_vars["ups.status"], nut_server, ups_name], 1.0
             )
-            yield ups_beeper_status
 
-        if "battery.charger.status" in client_vars:
-            battery_charger_status = GaugeMetricFamily(
-                "nut_battery_charger_status",
-                "Status of the battery charger",
-                labels=["status", "nut_server", "ups"],
-            )
-            battery_charger_status.add_metric(
-                [client_vars["battery.charger.status"], nut_server, self._ups_name], 1.0
-            )
-            yield battery_charger_status
-
-        for var in client_vars:
-            if var in METRICS:
-                formatted_name = var.replace(".", "_")
-                if METRICS[var]["unit"]:
-                    formatted_name = "_".join(
-                        ("nut", formatted_name, METRICS[var]["unit"])
+            for var, status in statuses:
+                value = client_vars.get(var)
+                if value is not None:
+                    status.add_metric([value, nut_server, ups_name], 1.0)
+
+            # Walk the known metrics rather than everything the UPS reports,
+            # which keeps the output order stable between scrapes
+            for var, (name, help_, unit) in _COMPILED_METRICS.items():
+                if var not in client_vars:
+                    continue
+                # Drop a malformed reading rather than failing the whole scrape
+                try:
+                    value = float(client_vars[var])
+                except ValueError:
+                    continue
+                if self._grouped:
+                    grouped.add_metric([nut_server, ups_name, var, unit], value)
+                    continue
+                if name not in metrics:
+                    metrics[name] = GaugeMetricFamily(
+                        name, help_, labels=_METRIC_LABELS
                     )
-                else:
-                    formatted_name = "_".join(("nut", formatted_name))
-                metric = GaugeMetricFamily(
-                    formatted_name, METRICS[var]["help"], labels=["nut_server", "ups"]
-                )
-                metric.add_metric([nut_server, self._ups_name], client_vars[var])
-                yield metric
+                metrics[name].add_metric([nut_server, ups_name], value)
+
+        yield info
+        yield ups_status
+        for _, status in statuses:
+            if status.samples:
+                yield status
+        if grouped.samples:
+            yield grouped
+        for metric in metrics.values():
+            yield metric
 
 
-if __name__ == "__main__":
-    REQUIRED_VARS = ["HOST", "UPS"]
+def _accepts_gzip(accept_encoding):
+    """Whether an Accept-Encoding header allows gzip, honouring q=0."""
+    qvalues = {}
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[name.strip().lower()] = q
+    # An explicit gzip entry overrides the * wildcard
+    q = qvalues.get("gzip", qvalues.get("x-gzip", qvalues.get("*", 0.0)))
+    return q > 0
+
 
-    for var in REQUIRED_VARS:
-        if var not in os.environ:
-            raise EnvironmentError("Failed because {} is not set.".format(var))
+def _etag_matches(if_none_match, etag):
+    """Weak comparison of an If-None-Match header against etag."""
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag in ("*", etag):
+            return True
+    return False
+
+
+def make_metrics_app(registry=REGISTRY, cache_ttl=5):
+    """WSGI app serving the registry with gzip and ETag support.
+
+    Rendered pages are kept for cache_ttl seconds per content type, so
+    repeated scrapes reuse both the text and its compressed form. Requests
+    filtered with name[] are rendered fresh and not cached.
+    """
+    pages = {}
+    lock = threading.Lock()
+
+    def build_page(encoder, content_type, source, compress=True):
+        body = encoder(source)
+        digest = hashlib.sha1(body).hexdigest()
+        # A strong ETag has to differ between content-codings
+        return {
+            "t": time.monotonic(),
+            "content_type": content_type,
+            "identity": (body, '"{}"'.format(digest)),
+            "gzip": (
+                (gzip.compress(body), '"{}-gzip"'.format(digest)) if compress else None
+            ),
+        }
+
+    def render(accept_header, names, use_gzip):
+        encoder, content_type = choose_encoder(accept_header)
+        if names:
+            return build_page(
+                encoder,
+                content_type,
+                registry.restricted_registry(names),
+                compress=use_gzip,
+            )
+        with lock:
+            page = pages.get(content_type)
+            if page is None or time.monotonic() - page["t"] >= cache_ttl:
+                page = build_page(encoder, content_type, registry)
+                pages[content_type] = page
+            return page
+
+    def metrics_app(environ, start_response):
+        params = parse_qs(environ.get("QUERY_STRING", ""))
+        use_gzip = _accepts_gzip(environ.get("HTTP_ACCEPT_ENCODING", ""))
+        page = render(environ.get("HTTP_ACCEPT"), params.get("name[]"), use_gzip)
+        if use_gzip:
+            body, etag = page["gzip"]
+            encoding_headers = [("Content-Encoding", "gzip")]
+        else:
+            body, etag = page["identity"]
+            encoding_headers = []
+        headers = [
+            ("Content-Type", page["content_type"]),
+            ("ETag", etag),
+            ("Vary", "Accept, Accept-Encoding"),
+        ]
+        if _etag_matches(environ.get("HTTP_IF_NONE_MATCH", ""), etag):
+            start_response("304 Not Modified", headers)
+            return []
+
+        headers += encoding_headers
+        headers.append(("Content-Length", str(len(body))))
+        start_response("200 OK", headers)
+        return [body]
+
+    return metrics_app
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, registry=REGISTRY, cache_ttl=5):
+    """Serve make_metrics_app on a daemon thread."""
+    httpd = make_server(
+        "",
+        port,
+        make_metrics_app(registry, cache_ttl),
+        ThreadingWSGIServer,
+        handler_class=_QuietHandler,
+    )
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s"
+    )
+    config = Config.from_environ()
 
-    host = os.environ.get("HOST")
-    nut_port = os.environ.get("NUT_PORT") or 3493
-    ups = os.environ.get("UPS")
-    exporter_port = os.environ.get("EXPORTER_PORT") or 9710
+    collector = NUTCollector(
+        host=config.host,
+        nut_port=config.nut_port,
+        ups_names=config.ups_names,
+        poll_interval=config.poll_interval,
+        grouped=config.grouped,
+    )
+    # Exit non-zero on a bad host or UPS name rather than serving empty scrapes
+    try:
+        collector.poll()
+        list(collector.collect())
+    except Exception:
+        logging.exception("Could not read UPS data from %s", config.host)
+        sys.exit(1)
 
-    start_http_server(int(exporter_port))
-    REGISTRY.register(NUTCollector(host=host, nut_port=nut_port, ups_name=ups))
+    collector.start()
+    REGISTRY.register(collector)
+    start_metrics_server(config.exporter_port, cache_ttl=config.cache_ttl)
 
-    while True:
-        time.sleep(1)
+    # The HTTP server runs in a daemon thread; park the main thread until killed
+    threading.Event().wait()